@@ -4,123 +4,263 @@ Comprehensive test runner for LeKiwi base container
 Tests container for StreamDeploy fleet deployment readiness
 """
 
+import functools
+import importlib.util
+import json
 import subprocess
 import sys
 import time
 import argparse
+from collections import deque
 from pathlib import Path
-from typing import List, Dict, Any
+from xml.etree import ElementTree
+from typing import List, Dict, Any, Optional, Set, Tuple
+
+from tests.build_support import BUILD_ENV, buildx_cmd, hash_build_context
+
+# Build context hash of the last passing smoke test, relative to the project root
+SMOKE_CACHE = Path(".cache") / "smoke.json"
+
+# JUnit report of the combined pytest run, relative to the project root
+JUNIT_XML = Path(".cache") / "junit.xml"
+
+# Modules provided by tests/requirements.txt; docker.errors rather than docker,
+# since the repo's docker/ directory would satisfy that as a namespace package
+TEST_MODULES = ["docker.errors", "filelock", "pytest", "xdist"]
+
+# Lines of command output kept for failure reports in non-verbose mode
+OUTPUT_TAIL_LINES = 200
+
+@functools.lru_cache(maxsize=None)
+def _tool_available(cmd: Tuple[str, ...]) -> bool:
+    """Check a tool's version command succeeds, once per process"""
+    try:
+        return subprocess.run(cmd, capture_output=True).returncode == 0
+    except OSError:
+        return False
 
 class TestRunner:
     """Main test runner for LeKiwi container validation"""
     
+    # (result key, test path, description) for the pytest suites
+    PYTEST_SUITES = [
+        ("docker_build", "tests/docker/test_build.py", "Docker build tests"),
+        ("streamdeploy_integration", "tests/integration/test_streamdeploy_integration.py", "StreamDeploy integration tests"),
+        ("production_config", "tests/production/test_config_validation.py", "Production configuration tests"),
+    ]
+    
+    # Image tags each pytest suite builds, removed by cleanup_test_artifacts.
+    # The shared lekiwi-base:test-shared image is kept for the next run to
+    # reuse while its build context is unchanged
+    SUITE_IMAGE_TAGS = {
+        "docker_build": [
+            "lekiwi-base:test-amd64",
+            "lekiwi-base:test-arm64",
+        ],
+        "streamdeploy_integration": [],
+        "production_config": [],
+    }
+    
     def __init__(self, verbose: bool = False, quick: bool = False):
         self.verbose = verbose
         self.quick = quick
         self.project_root = Path(__file__).parent
         self.test_results: Dict[str, Any] = {}
+        self._created_tags: Set[str] = set()
         
     def run_command(self, cmd: List[str], description: str) -> bool:
-        """Run a command and capture results"""
+        """Run a command and stream its output"""
         if self.verbose:
             print(f"🔄 {description}")
             print(f"   Command: {' '.join(cmd)}")
         
         try:
-            result = subprocess.run(
-                cmd, 
-                capture_output=True, 
-                text=True, 
-                cwd=self.project_root
-            )
-            
-            success = result.returncode == 0
-            
-            if self.verbose or not success:
-                if result.stdout:
-                    print(f"   STDOUT: {result.stdout}")
-                if result.stderr:
-                    print(f"   STDERR: {result.stderr}")
+            # Stream output line by line instead of buffering whole build logs;
+            # verbose mode tees it live, otherwise only the tail is kept for errors
+            tail = deque(maxlen=OUTPUT_TAIL_LINES)
+            with subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1,
+                cwd=self.project_root,
+                env=BUILD_ENV
+            ) as process:
+                for line in process.stdout:
+                    tail.append(line)
+                    if self.verbose:
+                        sys.stdout.write(line)
             
-            if success:
-                print(f"✅ {description}")
-            else:
-                print(f"❌ {description}")
-                
-            return success
+            output = "" if self.verbose else "".join(tail)
+            return self._report(description, process.returncode == 0, output, "")
             
         except Exception as e:
             print(f"❌ {description} - Exception: {e}")
             return False
     
+    def _report(self, description: str, success: bool, stdout: str, stderr: str) -> bool:
+        """Print command output and pass/fail status"""
+        if self.verbose or not success:
+            if stdout:
+                print(f"   STDOUT: {stdout}")
+            if stderr:
+                print(f"   STDERR: {stderr}")
+        
+        if success:
+            print(f"✅ {description}")
+        else:
+            print(f"❌ {description}")
+            
+        return success
+    
+    def _buildx_cmd(self, tag: str, platform: Optional[str] = None) -> List[str]:
+        """Build a BuildKit command line for a tag this run will clean up"""
+        self._created_tags.add(tag)
+        # Per-layer progress is only worth producing when someone is watching
+        verbosity = "--progress=plain" if self.verbose else "--quiet"
+        return buildx_cmd(tag, platform=platform, extra_args=[verbosity])
+    
     def check_prerequisites(self) -> bool:
         """Check if all prerequisites are available"""
         print("🔍 Checking prerequisites...")
         
         prerequisites = [
             (["docker", "--version"], "Docker availability"),
+            (["docker", "info"], "Docker daemon running"),
             ([sys.executable, "--version"], "Python availability"),
             (["docker", "buildx", "version"], "Docker Buildx for multi-arch builds")
         ]
         
         all_good = True
         for cmd, desc in prerequisites:
-            if not self.run_command(cmd, desc):
+            if not self.check_tool(cmd, desc):
                 all_good = False
         
         return all_good
     
+    def check_tool(self, cmd: List[str], description: str) -> bool:
+        """Check a tool is available using its cached version command"""
+        if self.verbose:
+            print(f"🔄 {description}")
+            print(f"   Command: {' '.join(cmd)}")
+        
+        available = _tool_available(tuple(cmd))
+        print(f"{'✅' if available else '❌'} {description}")
+        return available
+    
     def install_test_dependencies(self) -> bool:
         """Install required Python test dependencies"""
         print("\n📦 Installing test dependencies...")
         
-        dependencies = ["pytest", "pyzmq"]
-        cmd = [sys.executable, "-m", "pip", "install"] + dependencies
+        # Skip pip entirely when everything is already importable
+        if all(importlib.util.find_spec(module) for module in TEST_MODULES):
+            print("✅ Test dependencies already installed")
+            return True
+        
+        # The requirements file is fully pinned and hashed, so skip the resolver
+        cmd = [
+            sys.executable, "-m", "pip", "install",
+            "--no-deps", "--disable-pip-version-check",
+            "-r", "tests/requirements.txt"
+        ]
         
         return self.run_command(cmd, "Installing test dependencies")
     
+    def _pytest_cmd(self, *test_paths: str) -> List[str]:
+        """Build the pytest command line for one or more test paths"""
+        # loadgroup spreads tests across workers except xdist_group-marked classes
+        return [
+            sys.executable, "-m", "pytest", 
+            *test_paths, 
+            "-v" if self.verbose else "-q",
+            "-n", "auto", "--dist=loadgroup"
+        ]
+    
     def run_docker_build_tests(self) -> bool:
         """Run Docker container build tests"""
         print("\n🐳 Running Docker build tests...")
         
-        cmd = [
-            sys.executable, "-m", "pytest", 
-            "tests/docker/test_build.py", 
-            "-v" if self.verbose else "-q"
-        ]
+        cmd = self._pytest_cmd("tests/docker/test_build.py")
         
         success = self.run_command(cmd, "Docker build tests")
         self.test_results["docker_build"] = success
+        self._created_tags.update(self.SUITE_IMAGE_TAGS["docker_build"])
         return success
     
     def run_streamdeploy_integration_tests(self) -> bool:
         """Run StreamDeploy integration tests"""
         print("\n🚀 Running StreamDeploy integration tests...")
         
-        cmd = [
-            sys.executable, "-m", "pytest", 
-            "tests/integration/test_streamdeploy_integration.py", 
-            "-v" if self.verbose else "-q"
-        ]
+        cmd = self._pytest_cmd("tests/integration/test_streamdeploy_integration.py")
         
         success = self.run_command(cmd, "StreamDeploy integration tests")
         self.test_results["streamdeploy_integration"] = success
+        self._created_tags.update(self.SUITE_IMAGE_TAGS["streamdeploy_integration"])
         return success
     
     def run_production_config_tests(self) -> bool:
         """Run production configuration tests"""
         print("\n⚙️ Running production configuration tests...")
         
-        cmd = [
-            sys.executable, "-m", "pytest", 
-            "tests/production/test_config_validation.py", 
-            "-v" if self.verbose else "-q"
-        ]
+        cmd = self._pytest_cmd("tests/production/test_config_validation.py")
         
         success = self.run_command(cmd, "Production configuration tests")
         self.test_results["production_config"] = success
+        self._created_tags.update(self.SUITE_IMAGE_TAGS["production_config"])
         return success
     
+    def _parse_junit(self, junit_path: Path) -> Dict[str, bool]:
+        """Map each pytest suite to pass/fail using a JUnit XML report"""
+        results = {name: False for name, _, _ in self.PYTEST_SUITES}
+        try:
+            root = ElementTree.parse(junit_path).getroot()
+        except (OSError, ElementTree.ParseError):
+            return results
+        
+        # classname is the dotted test module path, e.g. tests.docker.test_build.TestDockerBuild;
+        # collection errors have an empty classname and the module path as their name
+        outcomes: Dict[str, List[bool]] = {name: [] for name, _, _ in self.PYTEST_SUITES}
+        for case in root.iter("testcase"):
+            classname = case.get("classname", "")
+            node = f"{classname}.{case.get('name', '')}" if classname else case.get("name", "")
+            # Skipped cases prove nothing, e.g. the whole production suite skips
+            # when the Docker daemon is down, so they don't count towards a pass
+            if case.find("skipped") is not None:
+                continue
+            failed = case.find("failure") is not None or case.find("error") is not None
+            for name, path, _ in self.PYTEST_SUITES:
+                module = path[:-len(".py")].replace("/", ".")
+                if node == module or node.startswith(module + "."):
+                    outcomes[name].append(not failed)
+        
+        # A suite with no executed cases fails rather than passing vacuously
+        for name, passed in outcomes.items():
+            results[name] = bool(passed) and all(passed)
+        return results
+    
+    def run_all_pytest_suites(self) -> bool:
+        """Run Docker build, integration and production tests in one pytest process"""
+        print("\n🧪 Running pytest suites...")
+        
+        # Remove stale results so a crashed run can't report old passes
+        junit_path = self.project_root / JUNIT_XML
+        junit_path.parent.mkdir(exist_ok=True)
+        if junit_path.exists():
+            junit_path.unlink()
+        
+        cmd = self._pytest_cmd(*(path for _, path, _ in self.PYTEST_SUITES))
+        cmd.append(f"--junit-xml={JUNIT_XML}")
+        success = self.run_command(cmd, "Pytest suites")
+        
+        results = self._parse_junit(junit_path)
+        for name, _, description in self.PYTEST_SUITES:
+            self.test_results[name] = results[name]
+            self._created_tags.update(self.SUITE_IMAGE_TAGS[name])
+            if self.verbose or not success:
+                print(f"{'✅' if results[name] else '❌'} {description}")
+        return success and all(results.values())
+    
     def run_multi_arch_build_test(self) -> bool:
         """Test multi-architecture build for Raspberry Pi"""
         if self.quick:
@@ -130,12 +270,7 @@ class TestRunner:
         print("\n🏗️ Testing multi-architecture build...")
         
         # Test ARM64 build for Raspberry Pi
-        cmd = [
-            "docker", "buildx", "build",
-            "--platform", "linux/arm64",
-            "--tag", "lekiwi-base:test-arm64-final",
-            "."
-        ]
+        cmd = self._buildx_cmd("lekiwi-base:test-arm64-final", platform="linux/arm64")
         
         success = self.run_command(cmd, "ARM64 build for Raspberry Pi")
         self.test_results["multi_arch_build"] = success
@@ -145,8 +280,21 @@ class TestRunner:
         """Run basic smoke test on built container"""
         print("\n💨 Running container smoke test...")
         
+        # Skip the build and run if this exact context already passed
+        smoke_cache = self.project_root / SMOKE_CACHE
+        context_hash = hash_build_context(self.project_root)
+        if smoke_cache.is_file():
+            try:
+                cached = json.loads(smoke_cache.read_text())
+            except ValueError:
+                cached = {}
+            if cached.get("context") == context_hash and cached.get("passed"):
+                print("✅ Container smoke test (context unchanged since last pass)")
+                self.test_results["smoke_test"] = True
+                return True
+        
         # Build container
-        build_cmd = ["docker", "build", "--tag", "lekiwi-base:smoke-test", "."]
+        build_cmd = self._buildx_cmd("lekiwi-base:smoke-test")
         if not self.run_command(build_cmd, "Building container for smoke test"):
             return False
         
@@ -160,26 +308,30 @@ class TestRunner:
         
         success = self.run_command(smoke_cmd, "Container smoke test")
         self.test_results["smoke_test"] = success
+        
+        if success:
+            smoke_cache.parent.mkdir(exist_ok=True)
+            smoke_cache.write_text(json.dumps({"context": context_hash, "passed": True}))
         return success
     
     def cleanup_test_artifacts(self) -> bool:
         """Clean up test containers and images"""
         print("\n🧹 Cleaning up test artifacts...")
         
-        # Get all test images
-        list_cmd = ["docker", "images", "--filter", "reference=lekiwi-base:*test*", "-q"]
+        if not self._created_tags:
+            return True
+        
+        # Remove only the tags this run built instead of enumerating every image
+        cleanup_cmd = ["docker", "rmi", "-f"] + sorted(self._created_tags)
         try:
-            result = subprocess.run(list_cmd, capture_output=True, text=True)
-            if result.returncode == 0 and result.stdout.strip():
-                image_ids = result.stdout.strip().split('\n')
-                
-                # Remove test images
-                cleanup_cmd = ["docker", "rmi", "-f"] + image_ids
-                return self.run_command(cleanup_cmd, "Cleaning up test images")
+            result = subprocess.run(cleanup_cmd, capture_output=True, text=True)
         except Exception as e:
             print(f"⚠️ Cleanup warning: {e}")
+            return True
         
-        return True
+        # Tags from skipped builds were never created; that's not a failure
+        errors = [line for line in result.stderr.splitlines() if "No such image" not in line]
+        return self._report("Cleaning up test images", not errors, "", "\n".join(errors))
     
     def print_summary(self):
         """Print test results summary"""
@@ -222,11 +374,10 @@ class TestRunner:
             print("❌ Failed to install test dependencies.")
             return False
         
-        # Run test suites
+        # Run test suites; the pytest suites share one pytest process,
+        # smoke and multi-arch builds stay serial as they share image tags
         test_suites = [
-            self.run_docker_build_tests,
-            self.run_streamdeploy_integration_tests,
-            self.run_production_config_tests,
+            self.run_all_pytest_suites,
             self.run_container_smoke_test,
             self.run_multi_arch_build_test
         ]
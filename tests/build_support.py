@@ -0,0 +1,159 @@
+"""
+Build helpers shared by run_tests.py and the pytest fixtures
+Keeps the BuildKit cache settings, the build context hash and the
+container polling the test suites share in one place
+"""
+
+import hashlib
+import os
+import posixpath
+import re
+import stat
+import time
+from pathlib import Path
+
+# Registry-backed BuildKit layer cache shared with CI; pushing to it needs
+# registry credentials, so exporting is opt-in via LEKIWI_BUILD_CACHE_PUSH=1
+CACHE_REF = os.environ.get(
+    "LEKIWI_BUILD_CACHE", "ghcr.io/streamdeploy/lekiwi-base-container:buildcache"
+)
+PUSH_CACHE = os.environ.get("LEKIWI_BUILD_CACHE_PUSH") == "1"
+
+# Published image, whose inline cache metadata is a fallback cache source
+CACHE_IMAGE = os.environ.get(
+    "LEKIWI_CACHE_IMAGE", "ghcr.io/streamdeploy/lekiwi-base-container:latest"
+)
+
+# The Dockerfile uses RUN --mount cache mounts, which need BuildKit
+BUILD_ENV = {**os.environ, "DOCKER_BUILDKIT": "1"}
+
+
+def buildx_cmd(tag, context=".", platform=None, labels=None, extra_args=()):
+    """Build a BuildKit command line that reuses the registry layer cache"""
+    cmd = [
+        "docker", "buildx", "build",
+        f"--cache-from=type=registry,ref={CACHE_REF}",
+        f"--cache-from=type=registry,ref={CACHE_IMAGE}",
+    ]
+    if PUSH_CACHE:
+        cmd.append(f"--cache-to=type=registry,ref={CACHE_REF},mode=max")
+    cmd += ["--build-arg", "BUILDKIT_INLINE_CACHE=1", "--load", "--tag", tag]
+    for key, value in (labels or {}).items():
+        cmd += ["--label", f"{key}={value}"]
+    cmd += list(extra_args)
+    if platform:
+        cmd += ["--platform", platform]
+    return cmd + [str(context)]
+
+
+def _dockerignore_regex(pattern):
+    """Translate a .dockerignore pattern into a regex over context-relative paths"""
+    regex, i = "", 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            regex, i = regex + "(?:.*/)?", i + 3
+        elif pattern.startswith("**", i):
+            regex, i = regex + ".*", i + 2
+        elif char == "*":
+            regex, i = regex + "[^/]*", i + 1
+        elif char == "?":
+            regex, i = regex + "[^/]", i + 1
+        elif char == "[" and "]" in pattern[i + 1:]:
+            end = pattern.index("]", i + 1)
+            regex, i = regex + pattern[i:end + 1].replace("[!", "[^", 1), end + 1
+        else:
+            regex, i = regex + re.escape(char), i + 1
+    return re.compile(regex)
+
+
+def load_dockerignore(project_root):
+    """Read .dockerignore as (pattern, regex, is_exception) rules in file order"""
+    try:
+        lines = (Path(project_root) / ".dockerignore").read_text().splitlines()
+    except FileNotFoundError:
+        return []
+    rules = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        exception = line.startswith("!")
+        # Docker cleans each pattern, so leading and trailing slashes don't matter
+        pattern = posixpath.normpath(line.lstrip("!").strip().lstrip("/"))
+        rules.append((pattern, _dockerignore_regex(pattern), exception))
+    return rules
+
+
+def is_ignored(rel_path, rules):
+    """Apply .dockerignore rules the way Docker does: last match wins, parents count"""
+    parts = rel_path.split("/")
+    candidates = ["/".join(parts[:n]) for n in range(1, len(parts) + 1)]
+    ignored = False
+    for _, regex, exception in rules:
+        if any(regex.fullmatch(candidate) for candidate in candidates):
+            ignored = not exception
+    return ignored
+
+
+def _may_reinclude(rel_dir, rules):
+    """Whether an exception rule could match something under an excluded directory"""
+    for pattern, _, exception in rules:
+        if exception:
+            literal = re.split(r"[*?\[]", pattern, maxsplit=1)[0]
+            if literal.startswith(rel_dir + "/") or (rel_dir + "/").startswith(literal):
+                return True
+    return False
+
+
+def build_context_files(project_root):
+    """List the regular files Docker sends as build context, relative to the root"""
+    project_root = Path(project_root)
+    rules = load_dockerignore(project_root)
+    files = []
+    for dirpath, dirnames, filenames in os.walk(project_root):
+        rel_dir = Path(dirpath).relative_to(project_root).as_posix()
+        prefix = "" if rel_dir == "." else rel_dir + "/"
+        # Don't descend into excluded directories such as .git/ or .venv/
+        dirnames[:] = [
+            d for d in dirnames
+            if not is_ignored(prefix + d, rules) or _may_reinclude(prefix + d, rules)
+        ]
+        for name in filenames:
+            rel_path = prefix + name
+            if is_ignored(rel_path, rules):
+                continue
+            # Symlinks, sockets and the like (e.g. dangling venv links) aren't hashed
+            if not stat.S_ISREG(os.lstat(os.path.join(dirpath, name)).st_mode):
+                continue
+            files.append(rel_path)
+    return sorted(files)
+
+
+def hash_build_context(project_root):
+    """Hash the paths and contents of every file in the .dockerignore-filtered context"""
+    project_root = Path(project_root)
+    digest = hashlib.blake2b()
+    for rel_path in build_context_files(project_root):
+        digest.update(rel_path.encode() + b"\0")
+        digest.update((project_root / rel_path).read_bytes())
+    return digest.hexdigest()
+
+
+def wait_running(container, timeout=10.0, interval=0.25):
+    """Wait until the container is running, returning False if it exits or is removed"""
+    # Imported here: run_tests.py loads this module before installing the docker SDK
+    from docker.errors import NotFound
+    
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            container.reload()
+        except NotFound:
+            # Auto-removed after exiting on its own
+            return False
+        if container.attrs["State"]["Running"]:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
@@ -0,0 +1,73 @@
+"""
+Shared fixtures for the LeKiwi container test suites
+Builds the container image once per session for all suites to reuse
+"""
+
+import os
+import subprocess
+import docker
+import pytest
+from filelock import FileLock
+from pathlib import Path
+from build_support import BUILD_ENV, buildx_cmd, hash_build_context
+
+# Tag for tests that only need the native image, so they reuse its layers
+SHARED_TAG = "lekiwi-base:test-shared"
+
+# Image label recording the hash of the build context the image was built from
+CONTEXT_LABEL = "lekiwi.context-hash"
+
+
+@pytest.fixture(scope="session")
+def project_root():
+    """Get project root directory"""
+    return Path(__file__).parent.parent
+
+
+@pytest.fixture(scope="session")
+def docker_client():
+    """Docker Engine API client shared by the tests, avoiding a CLI process per call"""
+    client = docker.from_env()
+    yield client
+    client.close()
+
+
+@pytest.fixture(scope="session")
+def build_image(project_root):
+    """Return a function that builds the project image under a tag"""
+    def build(tag, platform=None, labels=None):
+        build_cmd = buildx_cmd(tag, project_root, platform, labels)
+        return subprocess.run(build_cmd, capture_output=True, text=True, cwd=project_root, env=BUILD_ENV)
+    return build
+
+
+def _build_shared_image(build_image, docker_client, project_root):
+    """Build the shared native image unless an existing one matches the context"""
+    context_hash = hash_build_context(project_root)
+    try:
+        if docker_client.images.get(SHARED_TAG).labels.get(CONTEXT_LABEL) == context_hash:
+            return
+    except docker.errors.ImageNotFound:
+        pass
+    
+    build_result = build_image(SHARED_TAG, labels={CONTEXT_LABEL: context_hash})
+    assert build_result.returncode == 0, f"Build failed: {build_result.stderr}"
+
+
+@pytest.fixture(scope="session")
+def lekiwi_image(build_image, docker_client, project_root, tmp_path_factory):
+    """Build the native image once per session and return its tag"""
+    # The tag outlives the session, including run_tests.py's cleanup, so the
+    # next session can reuse it while the build context is unchanged
+    if not os.environ.get("PYTEST_XDIST_WORKER"):
+        _build_shared_image(build_image, docker_client, project_root)
+        return SHARED_TAG
+    
+    # Under xdist the basetemp parent is shared by this session's workers:
+    # the first one builds while the rest wait on the lock and then reuse the tag
+    built_marker = tmp_path_factory.getbasetemp().parent / "lekiwi_image.built"
+    with FileLock(f"{built_marker}.lock"):
+        if not built_marker.is_file():
+            _build_shared_image(build_image, docker_client, project_root)
+            built_marker.touch()
+    return SHARED_TAG
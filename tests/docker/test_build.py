@@ -8,17 +8,65 @@ import subprocess
 import json
 import os
 import tempfile
+import uuid
 import pytest
-from pathlib import Path
 
+
+@pytest.fixture(scope="session")
+def buildx_available():
+    """Check once per session whether buildx is available for multi-arch builds"""
+    buildx_check = subprocess.run(
+        ["docker", "buildx", "version"], 
+        capture_output=True, text=True
+    )
+    return buildx_check.returncode == 0
+
+
+@pytest.fixture(scope="session")
+def probe_container(lekiwi_image):
+    """Start one idle container from the shared image for probes to exec into"""
+    container_name = f"lekiwi-probe-{uuid.uuid4().hex[:8]}"
+    run_cmd = [
+        "docker", "run", "-d",
+        "--name", container_name,
+        "--entrypoint", "sleep",
+        lekiwi_image,
+        "infinity"
+    ]
+    
+    run_result = subprocess.run(run_cmd, capture_output=True, text=True)
+    assert run_result.returncode == 0, f"Probe container start failed: {run_result.stderr}"
+    
+    yield container_name
+    
+    subprocess.run(["docker", "rm", "-f", container_name], capture_output=True)
+
+
+@pytest.fixture(scope="session")
+def env_health_probe(probe_container):
+    """Dump the default environment and run the health check pgrep in one exec"""
+    # The [l] bracket stops pgrep from matching this sh -c command line itself
+    probe_cmd = [
+        "docker", "exec", probe_container,
+        "sh", "-c",
+        "env; echo ---PGREP---; pgrep -f '[l]erobot.robots.lekiwi.lekiwi_host'; echo $?"
+    ]
+    
+    probe_result = subprocess.run(probe_cmd, capture_output=True, text=True)
+    assert probe_result.returncode == 0, f"Environment/health probe failed: {probe_result.stderr}"
+    
+    env_output, pgrep_output = probe_result.stdout.split("---PGREP---\n", 1)
+    return {
+        "env": env_output,
+        "pgrep_exit": int(pgrep_output.strip().splitlines()[-1])
+    }
+
+
+# Keep the probe tests on one xdist worker so they share one probe container
+@pytest.mark.xdist_group("docker_build")
 class TestDockerBuild:
     """Test Docker container build process"""
     
-    @pytest.fixture
-    def project_root(self):
-        """Get project root directory"""
-        return Path(__file__).parent.parent.parent
-    
     @pytest.fixture
     def lerobot_root(self, project_root):
         """Get lerobot directory (Docker build context)"""
@@ -36,92 +84,48 @@ class TestDockerBuild:
             assert len(content) > 0, "Dockerfile is empty"
             assert "FROM python:" in content, "Dockerfile doesn't use Python base image"
     
-    def test_build_amd64(self, project_root):
+    def test_build_amd64(self, build_image):
         """Test AMD64 container build"""
-        cmd = [
-            "docker", "build",
-            "--platform", "linux/amd64",
-            "--tag", "lekiwi-base:test-amd64",
-            str(project_root)
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, cwd=project_root)
+        result = build_image("lekiwi-base:test-amd64", platform="linux/amd64")
         
         assert result.returncode == 0, f"AMD64 build failed: {result.stderr}"
-        assert "Successfully tagged lekiwi-base:test-amd64" in result.stdout
-    
-    def test_build_arm64(self, project_root):
-        """Test ARM64 container build for Raspberry Pi"""
-        # Check if buildx is available for multi-arch builds
-        buildx_check = subprocess.run(
-            ["docker", "buildx", "version"], 
+        
+        # BuildKit doesn't print "Successfully tagged", so check the tag directly
+        inspect_result = subprocess.run(
+            ["docker", "image", "inspect", "lekiwi-base:test-amd64"],
             capture_output=True, text=True
         )
-        
-        if buildx_check.returncode != 0:
+        assert inspect_result.returncode == 0, "AMD64 image was not tagged"
+    
+    def test_build_arm64(self, build_image, buildx_available):
+        """Test ARM64 container build for Raspberry Pi"""
+        if not buildx_available:
             pytest.skip("Docker buildx not available for multi-arch builds")
         
-        cmd = [
-            "docker", "buildx", "build",
-            "--platform", "linux/arm64",
-            "--tag", "lekiwi-base:test-arm64",
-            "--load",  # Load into local docker daemon
-            str(project_root)
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, cwd=project_root)
+        result = build_image("lekiwi-base:test-arm64", platform="linux/arm64")
         
         assert result.returncode == 0, f"ARM64 build failed: {result.stderr}"
     
-    def test_container_structure(self, project_root):
+    def test_container_structure(self, probe_container):
         """Test container internal structure and dependencies"""
-        # Build container first
-        build_cmd = [
-            "docker", "build",
-            "--tag", "lekiwi-base:test-structure",
-            str(project_root)
-        ]
-        
-        build_result = subprocess.run(build_cmd, capture_output=True, text=True, cwd=project_root)
-        assert build_result.returncode == 0, f"Build failed: {build_result.stderr}"
-        
-        # Test Python dependencies are installed
+        # Check Python dependencies and the lekiwi_host module in one exec
         python_test_cmd = [
-            "docker", "run", "--rm",
-            "lekiwi-base:test-structure",
-            "python", "-c", "import lerobot; import zmq; import cv2; print('Dependencies OK')"
+            "docker", "exec", probe_container,
+            "python", "-c",
+            "import lerobot, zmq, cv2; print('Dependencies OK'); "
+            "from lerobot.robots.lekiwi.lekiwi_host import main; print('LeKiwi host module OK')"
         ]
         
         python_result = subprocess.run(python_test_cmd, capture_output=True, text=True)
-        assert python_result.returncode == 0, f"Python dependencies test failed: {python_result.stderr}"
-        assert "Dependencies OK" in python_result.stdout
-        
-        # Test lekiwi_host module is available
-        lekiwi_test_cmd = [
-            "docker", "run", "--rm",
-            "lekiwi-base:test-structure",
-            "python", "-c", "from lerobot.robots.lekiwi.lekiwi_host import main; print('LeKiwi host module OK')"
-        ]
-        
-        lekiwi_result = subprocess.run(lekiwi_test_cmd, capture_output=True, text=True)
-        assert lekiwi_result.returncode == 0, f"LeKiwi host module test failed: {lekiwi_result.stderr}"
-        assert "LeKiwi host module OK" in lekiwi_result.stdout
+        assert python_result.returncode == 0, f"Container structure test failed: {python_result.stderr}"
+        assert "Dependencies OK" in python_result.stdout, f"Python dependencies test failed: {python_result.stderr}"
+        assert "LeKiwi host module OK" in python_result.stdout, f"LeKiwi host module test failed: {python_result.stderr}"
     
-    def test_container_user_security(self, project_root):
+    def test_container_user_security(self, probe_container):
         """Test container runs as non-root user (StreamDeploy security requirement)"""
-        build_cmd = [
-            "docker", "build",
-            "--tag", "lekiwi-base:test-security",
-            str(project_root)
-        ]
-        
-        build_result = subprocess.run(build_cmd, capture_output=True, text=True, cwd=project_root)
-        assert build_result.returncode == 0, f"Build failed: {build_result.stderr}"
-        
         # Test user is not root
         user_test_cmd = [
-            "docker", "run", "--rm",
-            "lekiwi-base:test-security",
+            "docker", "exec", probe_container,
             "whoami"
         ]
         
@@ -131,8 +135,7 @@ class TestDockerBuild:
         
         # Test user has correct UID/GID
         id_test_cmd = [
-            "docker", "run", "--rm",
-            "lekiwi-base:test-security",
+            "docker", "exec", probe_container,
             "id"
         ]
         
@@ -141,63 +144,24 @@ class TestDockerBuild:
         assert "uid=1000(robot)" in id_result.stdout
         assert "gid=1000(robot)" in id_result.stdout
     
-    def test_environment_variables(self, project_root):
+    def test_environment_variables(self, env_health_probe):
         """Test default environment variables are set correctly"""
-        build_cmd = [
-            "docker", "build",
-            "--tag", "lekiwi-base:test-env",
-            str(project_root)
-        ]
-        
-        build_result = subprocess.run(build_cmd, capture_output=True, text=True, cwd=project_root)
-        assert build_result.returncode == 0, f"Build failed: {build_result.stderr}"
-        
-        # Test environment variables
-        env_test_cmd = [
-            "docker", "run", "--rm",
-            "lekiwi-base:test-env",
-            "env"
-        ]
-        
-        env_result = subprocess.run(env_test_cmd, capture_output=True, text=True)
-        assert env_result.returncode == 0, f"Environment test failed: {env_result.stderr}"
-        
-        env_output = env_result.stdout
+        env_output = env_health_probe["env"]
         assert "ROBOT_ID=my-kiwi" in env_output
         assert "DEPLOY_ENV=production" in env_output
     
-    def test_health_check_command(self, project_root):
+    def test_health_check_command(self, env_health_probe):
         """Test health check command works"""
-        build_cmd = [
-            "docker", "build",
-            "--tag", "lekiwi-base:test-health",
-            str(project_root)
-        ]
-        
-        build_result = subprocess.run(build_cmd, capture_output=True, text=True, cwd=project_root)
-        assert build_result.returncode == 0, f"Build failed: {build_result.stderr}"
-        
-        # Test health check command directly
-        health_test_cmd = [
-            "docker", "run", "--rm",
-            "lekiwi-base:test-health",
-            "pgrep", "-f", "lerobot.robots.lekiwi.lekiwi_host"
-        ]
-        
-        # This should fail since lekiwi_host is not running, but command should exist
-        health_result = subprocess.run(health_test_cmd, capture_output=True, text=True)
         # pgrep returns 1 when no processes found, which is expected
-        assert health_result.returncode == 1, "Health check command should return 1 when process not found"
+        # since lekiwi_host is not running, but the command should exist
+        assert env_health_probe["pgrep_exit"] == 1, "Health check command should return 1 when process not found"
     
     def cleanup_test_images(self):
         """Clean up test images"""
         test_tags = [
             "lekiwi-base:test-amd64",
             "lekiwi-base:test-arm64", 
-            "lekiwi-base:test-structure",
-            "lekiwi-base:test-security",
-            "lekiwi-base:test-env",
-            "lekiwi-base:test-health"
+            "lekiwi-base:test-shared"
         ]
         
         for tag in test_tags:
@@ -4,336 +4,256 @@ Test suite for StreamDeploy integration
 Tests container compatibility with StreamDeploy agent deployment
 """
 
-import subprocess
 import json
 import time
 import socket
 import threading
+import uuid
+import docker
 import pytest
-import zmq
-from pathlib import Path
 import tempfile
 import os
+from build_support import wait_running
 
+
+def _wait_for_state(container, probe, expected, timeout, interval=0.25):
+    """Poll the container's inspect data until a probe yields an expected value"""
+    deadline = time.monotonic() + timeout
+    while True:
+        container.reload()
+        value = probe(container.attrs)
+        if value in expected or time.monotonic() >= deadline:
+            return value
+        time.sleep(interval)
+
+
+def _wait_health(container, terminal=frozenset({"healthy", "unhealthy"}), timeout=15.0):
+    """Wait until the container health status settles, returning the last status"""
+    return _wait_for_state(container, lambda attrs: attrs["State"].get("Health", {}).get("Status"), terminal, timeout)
+
+
+def _wait_for_logs(container, patterns, timeout=10.0):
+    """Follow the container logs until every pattern appears, returning any still missing"""
+    missing = set(patterns)
+    stream = container.logs(stream=True, follow=True, tail=200)
+    # Following blocks while the container is quiet, so close the stream at the deadline
+    timer = threading.Timer(timeout, stream.close)
+    timer.start()
+    logs_output = ""
+    try:
+        for chunk in stream:
+            # Match against everything read so far, as a line can span chunks
+            logs_output += chunk.decode(errors="replace")
+            missing = {pattern for pattern in missing if pattern not in logs_output}
+            if not missing:
+                break
+    finally:
+        timer.cancel()
+        timer.join()
+        try:
+            stream.close()
+        except OSError:
+            # Already closed by the timer
+            pass
+    return missing
+
+
+def _wait_for_log(container, pattern, timeout=10.0):
+    """Wait until the container logs contain a pattern"""
+    return not _wait_for_logs(container, [pattern], timeout)
+
+
+def _remove_container(container):
+    """Kill and remove a test container with its anonymous volumes in one call"""
+    try:
+        container.remove(force=True, v=True)
+    except docker.errors.APIError:
+        pass
+
+
+def _port_open(port):
+    """Check a local TCP port accepts connections"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.settimeout(0.5)
+        return s.connect_ex(("127.0.0.1", port)) == 0
+
+
+def _find_free_ports(count):
+    """Find distinct free ports for testing"""
+    # Hold every probe socket until all are bound so the OS can't hand out the
+    # same port twice; they are closed just before docker binds the ports
+    sockets = []
+    try:
+        for _ in range(count):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sockets.append(s)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind(('', 0))
+        return tuple(s.getsockname()[1] for s in sockets)
+    finally:
+        for s in sockets:
+            s.close()
+
+
+@pytest.fixture
+def test_container_name():
+    """Generate unique container name for tests"""
+    # Timestamps collide when xdist workers start tests in the same second
+    return f"lekiwi-test-{uuid.uuid4().hex[:8]}"
+
+
+# Keep the observational tests on one xdist worker so they share one container
+@pytest.mark.xdist_group("streamdeploy_observe")
 class TestStreamDeployIntegration:
-    """Test StreamDeploy agent integration"""
-    
-    @pytest.fixture
-    def project_root(self):
-        """Get project root directory"""
-        return Path(__file__).parent.parent.parent
+    """Test StreamDeploy agent integration against one shared running container"""
     
-    @pytest.fixture
-    def test_container_name(self):
-        """Generate unique container name for tests"""
-        return f"lekiwi-test-{int(time.time())}"
+    @pytest.fixture(scope="class")
+    def running_container(self, docker_client, lekiwi_image):
+        """Start one container with StreamDeploy settings for the read-only tests"""
+        cmd_port, obs_port = _find_free_ports(2)
+        
+        # StreamDeploy-style environment, health check tuning and ZMQ port mapping
+        container = docker_client.containers.run(
+            lekiwi_image,
+            detach=True,
+            name=f"lekiwi-test-{uuid.uuid4().hex[:8]}",
+            environment={
+                "ROBOT_ID": "fleet-robot-001",
+                "DEPLOY_ENV": "production",
+                "SD_DEVICE_ID": "device-12345",
+                "SD_BOOTSTRAP_TOKEN": "test-token-123",
+            },
+            # Durations are in nanoseconds; the test command comes from the image
+            healthcheck={"interval": 10 * 10**9, "timeout": 5 * 10**9, "retries": 3},
+            ports={
+                "5555/tcp": cmd_port,  # Default ZMQ command port
+                "5556/tcp": obs_port,  # Default ZMQ observation port
+            },
+        )
+        
+        try:
+            assert wait_running(container), "Container did not start"
+            yield {"container": container, "cmd_port": cmd_port, "obs_port": obs_port}
+        finally:
+            _remove_container(container)
     
-    def test_container_startup_with_streamdeploy_env(self, project_root, test_container_name):
+    def test_container_startup_with_streamdeploy_env(self, running_container):
         """Test container starts correctly with StreamDeploy environment variables"""
-        # Build container first
-        build_cmd = [
-            "docker", "build",
-            "--tag", "lekiwi-base:streamdeploy-test",
-            str(project_root)
-        ]
+        # Collect environment and PID 1 status in one exec; exec only
+        # succeeds against a running container, so it doubles as the status check
+        probe_result = running_container["container"].exec_run(
+            ["sh", "-c", "echo ---ENV---; env; echo ---STATUS---; cat /proc/1/status"]
+        )
+        probe_output = probe_result.output.decode(errors="replace")
+        assert probe_result.exit_code == 0, f"Container not running: {probe_output}"
         
-        build_result = subprocess.run(build_cmd, capture_output=True, text=True, cwd=project_root)
-        assert build_result.returncode == 0, f"Build failed: {build_result.stderr}"
+        env_output, status_output = probe_output.split("---STATUS---\n", 1)
         
-        # Test with StreamDeploy-style environment variables
-        run_cmd = [
-            "docker", "run", "-d",
-            "--name", test_container_name,
-            "-e", "ROBOT_ID=fleet-robot-001",
-            "-e", "DEPLOY_ENV=production",
-            "-e", "SD_DEVICE_ID=device-12345",
-            "-e", "SD_BOOTSTRAP_TOKEN=test-token-123",
-            "lekiwi-base:streamdeploy-test"
-        ]
-        
-        run_result = subprocess.run(run_cmd, capture_output=True, text=True)
-        assert run_result.returncode == 0, f"Container start failed: {run_result.stderr}"
+        # Check environment variables are set correctly
+        assert "ROBOT_ID=fleet-robot-001" in env_output
+        assert "DEPLOY_ENV=production" in env_output
+        assert "SD_DEVICE_ID=device-12345" in env_output
         
-        try:
-            # Wait a moment for container to start
-            time.sleep(2)
-            
-            # Check container is running
-            status_cmd = ["docker", "ps", "--filter", f"name={test_container_name}", "--format", "{{.Status}}"]
-            status_result = subprocess.run(status_cmd, capture_output=True, text=True)
-            assert "Up" in status_result.stdout, f"Container not running: {status_result.stdout}"
-            
-            # Check environment variables are set correctly
-            env_cmd = ["docker", "exec", test_container_name, "env"]
-            env_result = subprocess.run(env_cmd, capture_output=True, text=True)
-            assert env_result.returncode == 0, f"Environment check failed: {env_result.stderr}"
-            
-            env_output = env_result.stdout
-            assert "ROBOT_ID=fleet-robot-001" in env_output
-            assert "DEPLOY_ENV=production" in env_output
-            assert "SD_DEVICE_ID=device-12345" in env_output
-            
-        finally:
-            # Cleanup
-            subprocess.run(["docker", "stop", test_container_name], capture_output=True)
-            subprocess.run(["docker", "rm", test_container_name], capture_output=True)
+        # Check the init process is alive
+        assert "State:" in status_output, f"PID 1 status unavailable: {status_output}"
+        assert "zombie" not in status_output, f"PID 1 is a zombie: {status_output}"
     
-    def test_health_check_integration(self, project_root, test_container_name):
+    def test_health_check_integration(self, running_container):
         """Test health check works for StreamDeploy monitoring"""
-        # Build container
-        build_cmd = [
-            "docker", "build",
-            "--tag", "lekiwi-base:health-test",
-            str(project_root)
-        ]
-        
-        build_result = subprocess.run(build_cmd, capture_output=True, text=True, cwd=project_root)
-        assert build_result.returncode == 0, f"Build failed: {build_result.stderr}"
+        container = running_container["container"]
         
-        # Start container with health check
-        run_cmd = [
-            "docker", "run", "-d",
-            "--name", test_container_name,
-            "--health-interval=10s",
-            "--health-timeout=5s",
-            "--health-retries=3",
-            "lekiwi-base:health-test"
-        ]
+        # Wait for the first health check to settle; this also refreshes the attrs
+        health_status = _wait_health(container)
         
-        run_result = subprocess.run(run_cmd, capture_output=True, text=True)
-        assert run_result.returncode == 0, f"Container start failed: {run_result.stderr}"
+        state = container.attrs["State"]["Status"]
+        assert state == "running", f"Container not running: {state}"
         
-        try:
-            # Wait for health check to run
-            time.sleep(15)
-            
-            # Check health status
-            health_cmd = ["docker", "inspect", test_container_name, "--format", "{{.State.Health.Status}}"]
-            health_result = subprocess.run(health_cmd, capture_output=True, text=True)
-            
-            # Health check should be unhealthy since lekiwi_host process isn't running
-            # This is expected behavior for testing
-            health_status = health_result.stdout.strip()
-            assert health_status in ["unhealthy", "starting"], f"Unexpected health status: {health_status}"
-            
-        finally:
-            # Cleanup
-            subprocess.run(["docker", "stop", test_container_name], capture_output=True)
-            subprocess.run(["docker", "rm", test_container_name], capture_output=True)
+        # The health check verifies python, ffmpeg and ssl, which the image provides
+        assert health_status == "healthy", f"Unexpected health status: {health_status}"
     
-    def test_zmq_port_binding(self, project_root, test_container_name):
+    def test_zmq_port_binding(self, running_container):
         """Test ZMQ ports can be bound for external communication"""
-        # Build container
-        build_cmd = [
-            "docker", "build",
-            "--tag", "lekiwi-base:zmq-test",
-            str(project_root)
-        ]
+        # Test the published ZMQ ports accept TCP connections
+        cmd_accessible = _port_open(running_container["cmd_port"])
+        obs_accessible = _port_open(running_container["obs_port"])
         
-        build_result = subprocess.run(build_cmd, capture_output=True, text=True, cwd=project_root)
-        assert build_result.returncode == 0, f"Build failed: {build_result.stderr}"
-        
-        # Find available ports
-        cmd_port = self._find_free_port()
-        obs_port = self._find_free_port()
+        # At least one port should be accessible (container is running)
+        assert cmd_accessible or obs_accessible, "No ZMQ ports accessible"
+    
+    def test_logging_format(self, running_container):
+        """Test container logging is compatible with StreamDeploy log collection"""
+        container = running_container["container"]
         
-        # Start container with port mapping
-        run_cmd = [
-            "docker", "run", "-d",
-            "--name", test_container_name,
-            "-p", f"{cmd_port}:5555",  # Default ZMQ command port
-            "-p", f"{obs_port}:5556",  # Default ZMQ observation port
-            "lekiwi-base:zmq-test"
+        # Should contain startup messages
+        expected_patterns = [
+            "Configuring LeKiwi",
+            "Connecting LeKiwi", 
+            "Starting HostAgent"
         ]
         
-        run_result = subprocess.run(run_cmd, capture_output=True, text=True)
-        assert run_result.returncode == 0, f"Container start failed: {run_result.stderr}"
-        
-        try:
-            # Wait for container to start
-            time.sleep(3)
-            
-            # Test ZMQ connection (should fail but ports should be bound)
-            context = zmq.Context()
-            
-            # Test command socket
-            cmd_socket = context.socket(zmq.PUSH)
-            try:
-                cmd_socket.connect(f"tcp://localhost:{cmd_port}")
-                # If we get here, port is accessible
-                cmd_accessible = True
-            except Exception:
-                cmd_accessible = False
-            finally:
-                cmd_socket.close()
-            
-            # Test observation socket  
-            obs_socket = context.socket(zmq.PULL)
-            obs_socket.setsockopt(zmq.RCVTIMEO, 1000)  # 1 second timeout
-            try:
-                obs_socket.connect(f"tcp://localhost:{obs_port}")
-                obs_accessible = True
-            except Exception:
-                obs_accessible = False
-            finally:
-                obs_socket.close()
-                
-            context.term()
-            
-            # At least one port should be accessible (container is running)
-            assert cmd_accessible or obs_accessible, "No ZMQ ports accessible"
-            
-        finally:
-            # Cleanup
-            subprocess.run(["docker", "stop", test_container_name], capture_output=True)
-            subprocess.run(["docker", "rm", test_container_name], capture_output=True)
+        # Follow the logs until every startup message has been logged
+        missing = _wait_for_logs(container, expected_patterns)
+        assert not missing, f"Expected log patterns not found: {sorted(missing)}"
+
+
+class TestStreamDeployLifecycle:
+    """Test StreamDeploy scenarios that stop or constrain their own container"""
     
-    def test_graceful_shutdown(self, project_root, test_container_name):
+    def test_graceful_shutdown(self, docker_client, lekiwi_image, test_container_name):
         """Test container handles SIGTERM gracefully (StreamDeploy requirement)"""
-        # Build container
-        build_cmd = [
-            "docker", "build",
-            "--tag", "lekiwi-base:shutdown-test",
-            str(project_root)
-        ]
-        
-        build_result = subprocess.run(build_cmd, capture_output=True, text=True, cwd=project_root)
-        assert build_result.returncode == 0, f"Build failed: {build_result.stderr}"
-        
         # Start container
-        run_cmd = [
-            "docker", "run", "-d",
-            "--name", test_container_name,
-            "lekiwi-base:shutdown-test"
-        ]
-        
-        run_result = subprocess.run(run_cmd, capture_output=True, text=True)
-        assert run_result.returncode == 0, f"Container start failed: {run_result.stderr}"
+        container = docker_client.containers.run(lekiwi_image, detach=True, name=test_container_name)
         
         try:
-            # Wait for container to start
-            time.sleep(2)
+            # Wait until the SIGTERM trap is about to be installed
+            assert _wait_for_log(container, "Starting HostAgent"), "Container did not start"
             
             # Send SIGTERM and measure shutdown time
             start_time = time.time()
-            stop_cmd = ["docker", "stop", "--time", "10", test_container_name]
-            stop_result = subprocess.run(stop_cmd, capture_output=True, text=True)
+            container.stop(timeout=10)
             shutdown_time = time.time() - start_time
             
-            assert stop_result.returncode == 0, f"Container stop failed: {stop_result.stderr}"
             assert shutdown_time < 10, f"Container took too long to shutdown: {shutdown_time}s"
             
             # Check container exited cleanly
-            inspect_cmd = ["docker", "inspect", test_container_name, "--format", "{{.State.ExitCode}}"]
-            inspect_result = subprocess.run(inspect_cmd, capture_output=True, text=True)
-            exit_code = int(inspect_result.stdout.strip())
+            container.reload()
+            exit_code = container.attrs["State"]["ExitCode"]
             assert exit_code == 0, f"Container didn't exit cleanly: exit code {exit_code}"
             
         finally:
             # Cleanup
-            subprocess.run(["docker", "rm", test_container_name], capture_output=True)
+            _remove_container(container)
     
-    def test_resource_constraints(self, project_root, test_container_name):
+    def test_resource_constraints(self, docker_client, lekiwi_image, test_container_name):
         """Test container works within resource constraints (fleet efficiency)"""
-        # Build container
-        build_cmd = [
-            "docker", "build",
-            "--tag", "lekiwi-base:resource-test",
-            str(project_root)
-        ]
-        
-        build_result = subprocess.run(build_cmd, capture_output=True, text=True, cwd=project_root)
-        assert build_result.returncode == 0, f"Build failed: {build_result.stderr}"
-        
         # Start container with resource limits
-        run_cmd = [
-            "docker", "run", "-d",
-            "--name", test_container_name,
-            "--memory", "512m",  # 512MB memory limit
-            "--cpus", "1.0",     # 1 CPU limit
-            "lekiwi-base:resource-test"
-        ]
-        
-        run_result = subprocess.run(run_cmd, capture_output=True, text=True)
-        assert run_result.returncode == 0, f"Container start with limits failed: {run_result.stderr}"
+        container = docker_client.containers.run(
+            lekiwi_image,
+            detach=True,
+            name=test_container_name,
+            mem_limit="512m",           # 512MB memory limit
+            nano_cpus=1_000_000_000,    # 1 CPU limit
+        )
         
         try:
-            # Wait for container to start
-            time.sleep(3)
+            # Wait for container to start; this also refreshes the attrs
+            assert wait_running(container), "Container did not start"
             
-            # Check container is still running under constraints
-            status_cmd = ["docker", "ps", "--filter", f"name={test_container_name}", "--format", "{{.Status}}"]
-            status_result = subprocess.run(status_cmd, capture_output=True, text=True)
-            assert "Up" in status_result.stdout, f"Container not running under constraints: {status_result.stdout}"
+            # Check container is still running and the limits were applied
+            state = container.attrs["State"]["Status"]
+            memory = container.attrs["HostConfig"]["Memory"]
+            nano_cpus = container.attrs["HostConfig"]["NanoCpus"]
+            assert state == "running", f"Container not running under constraints: {state}"
+            assert memory == 512 * 1024 * 1024, f"Memory limit not applied: {memory}"
+            assert nano_cpus == 1_000_000_000, f"CPU limit not applied: {nano_cpus}"
             
             # Check memory usage
-            stats_cmd = ["docker", "stats", "--no-stream", "--format", "table {{.MemUsage}}", test_container_name]
-            stats_result = subprocess.run(stats_cmd, capture_output=True, text=True)
-            assert stats_result.returncode == 0, f"Stats check failed: {stats_result.stderr}"
-            
-        finally:
-            # Cleanup
-            subprocess.run(["docker", "stop", test_container_name], capture_output=True)
-            subprocess.run(["docker", "rm", test_container_name], capture_output=True)
-    
-    def test_logging_format(self, project_root, test_container_name):
-        """Test container logging is compatible with StreamDeploy log collection"""
-        # Build container
-        build_cmd = [
-            "docker", "build",
-            "--tag", "lekiwi-base:logging-test",
-            str(project_root)
-        ]
-        
-        build_result = subprocess.run(build_cmd, capture_output=True, text=True, cwd=project_root)
-        assert build_result.returncode == 0, f"Build failed: {build_result.stderr}"
-        
-        # Start container
-        run_cmd = [
-            "docker", "run", "-d",
-            "--name", test_container_name,
-            "lekiwi-base:logging-test"
-        ]
-        
-        run_result = subprocess.run(run_cmd, capture_output=True, text=True)
-        assert run_result.returncode == 0, f"Container start failed: {run_result.stderr}"
-        
-        try:
-            # Wait for some logs to be generated
-            time.sleep(5)
-            
-            # Get container logs
-            logs_cmd = ["docker", "logs", test_container_name]
-            logs_result = subprocess.run(logs_cmd, capture_output=True, text=True)
-            assert logs_result.returncode == 0, f"Logs retrieval failed: {logs_result.stderr}"
-            
-            logs_output = logs_result.stdout + logs_result.stderr
-            
-            # Check for expected log patterns
-            assert len(logs_output) > 0, "No logs generated"
-            
-            # Should contain startup messages
-            expected_patterns = [
-                "Configuring LeKiwi",
-                "Connecting LeKiwi", 
-                "Starting HostAgent"
-            ]
-            
-            for pattern in expected_patterns:
-                assert pattern in logs_output, f"Expected log pattern not found: {pattern}"
+            stats = container.stats(stream=False)
+            assert stats.get("memory_stats"), f"Stats check failed: {stats}"
             
         finally:
             # Cleanup
-            subprocess.run(["docker", "stop", test_container_name], capture_output=True)
-            subprocess.run(["docker", "rm", test_container_name], capture_output=True)
-    
-    def _find_free_port(self):
-        """Find a free port for testing"""
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind(('', 0))
-            s.listen(1)
-            port = s.getsockname()[1]
-        return port
+            _remove_container(container)
 
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])